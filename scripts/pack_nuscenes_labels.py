@@ -0,0 +1,37 @@
+import os
+import sys
+import lmdb
+from tqdm import tqdm
+
+sys.path.append(os.path.abspath(os.path.join(__file__, '../..')))
+
+from src.utils.configs import get_default_configuration
+
+
+# Upper bound on the size of the database (sparse file, so only the space
+# actually used is allocated on disk)
+MAP_SIZE = 1 << 40
+
+
+if __name__ == '__main__':
+
+    # Load the default configuration
+    config = get_default_configuration()
+    config.merge_from_file('configs/datasets/nuscenes.yml')
+
+    label_root = os.path.expandvars(config.label_root)
+    label_db = os.path.expandvars(config.label_db or label_root + '.lmdb')
+
+    # Collect the generated label files
+    filenames = sorted(name for name in os.listdir(label_root) 
+                       if name.endswith('.png'))
+
+    # Copy encoded labels into a single database keyed by sample data token
+    print("\nPacking labels into " + label_db + "...")
+    env = lmdb.open(label_db, map_size=MAP_SIZE)
+    with env.begin(write=True) as txn:
+        for filename in tqdm(filenames):
+            token = os.path.splitext(filename)[0]
+            with open(os.path.join(label_root, filename), 'rb') as f:
+                txn.put(token.encode(), f.read())
+    env.close()
@@ -1,27 +1,15 @@
 import torch
-from torch.utils.data import Dataset
 
-class AugmentedMapDataset(Dataset):
 
-    def __init__(self, dataset, hflip=True):
-        self.dataset = dataset
-        self.hflip = hflip
-    
-    def __len__(self):
-        return len(self.dataset)
-    
-    def __getitem__(self, index):
-        image, calib, labels, mask = self.dataset[index]
-
-        # Apply data augmentation
-        if self.hflip:
-            image, labels, mask = random_hflip(image, labels, mask)
-
-        return image, calib, labels, mask
-
-    
-def random_hflip(image, labels, mask):
-    image = torch.flip(image, (-1,))
-    labels = torch.flip(labels.int(), (-1,)).bool()
-    mask = torch.flip(mask.int(), (-1,)).bool()
-    return image, labels, mask
\ No newline at end of file
+@torch.no_grad()
+def random_hflip(image, labels, mask, prob=0.5):
+    """
+    Flip a random subset of a batch horizontally. Applied to the whole batch 
+    at once after it has been moved to the GPU, rather than per example in 
+    the dataloader workers.
+    """
+    flip = torch.rand(image.size(0), device=image.device) < prob
+    image = torch.where(flip.view(-1, 1, 1, 1), image.flip(-1), image)
+    labels = torch.where(flip.view(-1, 1, 1, 1), labels.flip(-1), labels)
+    mask = torch.where(flip.view(-1, 1, 1), mask.flip(-1), mask)
+    return image, labels, mask
@@ -0,0 +1,121 @@
+import copy
+import numpy as np
+
+from nvidia.dali import fn, types, pipeline_def
+from nvidia.dali.plugin.pytorch import DALIGenericIterator
+
+from ..utils.distributed import get_rank, get_world_size, get_local_rank
+
+
+class NuScenesDaliSource(object):
+    """
+    Per-sample external source which reads encoded images and labels for a
+    NuScenesMapDataset. Images are decoded and resized by DALI on the GPU.
+    """
+
+    def __init__(self, dataset, epoch_size, batch_size, seed=0):
+
+        # Drop the NuScenes tables so that the source is cheap to pickle
+        # into the DALI worker processes
+        self.dataset = copy.copy(dataset)
+        self.dataset.nuscenes = None
+
+        self.num_samples = epoch_size // get_world_size()
+        self.num_batches = self.num_samples // batch_size
+        self.rank = get_rank()
+        self.world_size = get_world_size()
+        self.seed = seed
+
+
+    def __len__(self):
+        return self.num_batches
+
+
+    def get_indices(self, epoch):
+
+        # Sample with replacement, consistently across processes
+        rng = np.random.default_rng(self.seed + epoch)
+        indices = rng.integers(len(self.dataset),
+                               size=self.num_samples * self.world_size)
+        return indices[self.rank::self.world_size]
+
+
+    def __call__(self, sample_info):
+
+        if sample_info.iteration >= self.num_batches:
+            raise StopIteration
+
+        # Cache the sampling order for the current epoch
+        if getattr(self, 'epoch', None) != sample_info.epoch_idx:
+            self.epoch = sample_info.epoch_idx
+            self.indices = self.get_indices(self.epoch)
+        index = self.indices[sample_info.idx_in_epoch]
+        token = self.dataset.tokens[index]
+
+        # Load encoded image
+        with open(self.dataset.image_paths[token], 'rb') as f:
+            image = np.frombuffer(f.read(), dtype=np.uint8)
+
+        calib = self.dataset.load_calib(token).numpy()
+        labels, mask = self.dataset.load_labels(token)
+
+        return image, calib, labels.numpy(), mask.numpy()
+
+
+@pipeline_def
+def nuscenes_pipeline(source, image_size):
+
+    images, calib, labels, mask = fn.external_source(
+        source, num_outputs=4, batch=False, parallel=True)
+
+    # Decode using nvJPEG and resize to input resolution on the GPU
+    images = fn.decoders.image(images, device='mixed',
+                               output_type=types.RGB)
+    images = fn.resize(images, resize_x=image_size[0],
+                       resize_y=image_size[1])
+
+    # Convert to a CHW float tensor in [0, 1], matching to_tensor
+    images = fn.crop_mirror_normalize(images, dtype=types.FLOAT,
+                                      output_layout='CHW',
+                                      mean=[0.], std=[255.])
+
+    return images, calib, labels, mask
+
+
+class DaliLoader(object):
+
+    def __init__(self, pipeline, source):
+        self.source = source
+        self.iterator = DALIGenericIterator(
+            pipeline, ['image', 'calib', 'labels', 'mask'], auto_reset=True)
+
+    def __len__(self):
+        return len(self.source)
+
+    def __iter__(self):
+        for outputs in self.iterator:
+            batch = outputs[0]
+            yield batch['image'], batch['calib'], batch['labels'], \
+                batch['mask']
+
+
+def build_dali_train_loader(train_data, config):
+
+    source = NuScenesDaliSource(train_data, config.epoch_size,
+                                config.batch_size)
+
+    # The parallel external source needs at least one python worker, even 
+    # though num_workers may be zero for the standard dataloader
+    num_workers = max(1, config.num_workers)
+
+    # Python workers are spawned since CUDA is already initialised
+    pipeline = nuscenes_pipeline(source, config.img_size,
+                                 batch_size=config.batch_size,
+                                 num_threads=num_workers,
+                                 device_id=config.gpus[get_local_rank()],
+                                 py_num_workers=num_workers,
+                                 py_start_method='spawn',
+                                 prefetch_queue_depth=2)
+    pipeline.build()
+
+    return DaliLoader(pipeline, source)
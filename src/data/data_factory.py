@@ -1,17 +1,20 @@
 import os
-from torch.utils.data import DataLoader, RandomSampler
-from .augmentation import AugmentedMapDataset
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
 
-from nuscenes import NuScenes
-from .nuscenes.dataset import NuScenesMapDataset
-from .nuscenes.splits import TRAIN_SCENES, VAL_SCENES, CALIBRATION_SCENES
+from .sampler import ReplacementSampler
+from ..utils.distributed import is_distributed, get_rank, get_world_size
 
-# from argoverse.data_loading.argoverse_tracking_loader import ArgoverseTrackingLoader
-# from .argoverse.dataset import ArgoverseMapDataset
-# from .argoverse.splits import TRAIN_LOGS, VAL_LOGS
 
+# Dataset devkits are imported inside the corresponding builder, so that 
+# importing this module does not pay for loading devkits which are not used
 
 def build_nuscenes_datasets(config):
+    from nuscenes import NuScenes
+    from .nuscenes.dataset import NuScenesMapDataset, index_label_files
+    from .nuscenes.splits import TRAIN_SCENES, VAL_SCENES, CALIBRATION_SCENES
+
     print('==> Loading NuScenes dataset...')
     nuscenes = NuScenes(config.nuscenes_version, 
                         os.path.expandvars(config.dataroot))
@@ -22,14 +25,24 @@ def build_nuscenes_datasets(config):
     else:
         train_scenes = TRAIN_SCENES
     
+    # Scan the label directory once, shared by both splits
+    label_paths = None if config.label_db \
+        else index_label_files(config.label_root)
+    
     train_data = NuScenesMapDataset(nuscenes, config.label_root, 
-                                    config.img_size, train_scenes)
+                                    config.img_size, train_scenes,
+                                    config.label_db, label_paths)
     val_data = NuScenesMapDataset(nuscenes, config.label_root, 
-                                  config.img_size, VAL_SCENES)
+                                  config.img_size, VAL_SCENES, 
+                                  config.label_db, label_paths)
     return train_data, val_data
 
 
 # def build_argoverse_datasets(config):
+#     from argoverse.data_loading.argoverse_tracking_loader import ArgoverseTrackingLoader
+#     from .argoverse.dataset import ArgoverseMapDataset
+#     from .argoverse.splits import TRAIN_LOGS, VAL_LOGS
+
 #     print('==> Loading Argoverse dataset...')
 #     dataroot = os.path.expandvars(config.dataroot)
     
@@ -59,33 +72,69 @@ def build_datasets(dataset_name, config):
 
 def build_trainval_datasets(dataset_name, config):
 
-    # Construct the base dataset
+    # Construct the base dataset. Data augmentation is applied to each 
+    # batch on the GPU during training (see augmentation.random_hflip)
     train_data, val_data = build_datasets(dataset_name, config)
 
-    # Add data augmentation to train dataset
-    train_data = AugmentedMapDataset(train_data, config.hflip)
-
     return train_data, val_data
 
 
+def seed_worker(worker_id):
+    # Derive numpy seed from the per-worker torch seed so that workers 
+    # (which persist across epochs) do not share random state
+    seed = torch.initial_seed() % 2 ** 32
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
 def build_dataloaders(dataset_name, config):
 
     # Build training and validation datasets
     train_data, val_data = build_trainval_datasets(dataset_name, config)
 
+    # Sample training examples with replacement, sharded across processes 
+    # when training on multiple GPUs
+    sampler = ReplacementSampler(train_data, config.epoch_size, get_rank(), 
+                                 get_world_size())
+    
+    # Split the validation set between processes. Each example is evaluated
+    # exactly once, unlike DistributedSampler which pads the shards with 
+    # repeated examples
+    if is_distributed():
+        val_data = Subset(val_data, range(get_rank(), len(val_data), 
+                                          get_world_size()))
+
+    # Keep workers alive between epochs to avoid reloading the datasets
+    persistent = config.num_workers > 0
+
+    # Page-locked memory is only useful when copying batches to the GPU
+    pin_memory = len(config.gpus) > 0
+
     # Create training set dataloader
-    sampler = RandomSampler(train_data, True, config.epoch_size)
-    train_loader = DataLoader(train_data, config.batch_size, sampler=sampler,
-                              num_workers=config.num_workers)
+    if config.dali:
+        train_loader = build_dali_dataloader(dataset_name, train_data, config)
+    else:
+        train_loader = DataLoader(train_data, config.batch_size, 
+                                  sampler=sampler,
+                                  num_workers=config.num_workers, 
+                                  pin_memory=pin_memory, drop_last=True,
+                                  persistent_workers=persistent,
+                                  worker_init_fn=seed_worker)
     
     # Create validation dataloader
     val_loader = DataLoader(val_data, config.batch_size, 
-                            num_workers=config.num_workers)
+                            num_workers=config.num_workers, pin_memory=pin_memory,
+                            persistent_workers=persistent,
+                            worker_init_fn=seed_worker)
     
     return train_loader, val_loader
 
-    
 
+def build_dali_dataloader(dataset_name, train_data, config):
 
+    # Decode and resize training images on the GPU using NVIDIA DALI
+    if dataset_name != 'nuscenes':
+        raise ValueError(f"DALI loading is not supported for '{dataset_name}'")
     
-
+    from .dali import build_dali_train_loader
+    return build_dali_train_loader(train_data, config)
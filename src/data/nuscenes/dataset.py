@@ -1,4 +1,6 @@
+import io
 import os
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 from PIL import Image, ImageFile
@@ -6,20 +8,41 @@ from nuscenes import NuScenes
 from torchvision.transforms.functional import to_tensor
 
 from .utils import CAMERA_NAMES, NUSCENES_CLASS_NAMES, iterate_samples
-from ..utils import decode_binary_labels
+from ..utils import unpack_binary_labels
 
 class NuScenesMapDataset(Dataset):
 
     def __init__(self, nuscenes, map_root,  image_size=(800, 450), 
-                 scene_names=None):
+                 scene_names=None, label_db=None, label_paths=None):
         
         self.nuscenes = nuscenes
         self.map_root = os.path.expandvars(map_root)
         self.image_size = image_size
 
+        # Labels are read from a packed LMDB database if one is provided
+        self.label_db = os.path.expandvars(label_db) if label_db else None
+        self.label_env = None
+
         # Preload the list of tokens in the dataset
         self.get_tokens(scene_names)
 
+        # Resolve image paths and calibration up front, so that dataloader
+        # workers share these tables with the parent process after forking
+        self.image_paths = dict()
+        self.calibs = dict()
+        for token in self.tokens:
+            self.image_paths[token] = self.nuscenes.get_sample_data_path(token)
+            self.calibs[token] = self.get_calib(token)
+        
+        # Keep only the label files belonging to this split, scanning the 
+        # label directory unless an index has already been provided
+        if self.label_db is None:
+            if label_paths is None:
+                label_paths = index_label_files(self.map_root)
+            self.label_paths = { token : label_paths[token] 
+                                 for token in self.tokens 
+                                 if token in label_paths }
+
         # Allow PIL to load partially corrupted images
         # (otherwise training crashes at the most inconvenient possible times!)
         ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -63,7 +86,7 @@ class NuScenesMapDataset(Dataset):
     def load_image(self, token):
 
         # Load image as a PIL image
-        image = Image.open(self.nuscenes.get_sample_data_path(token))
+        image = Image.open(self.image_paths[token])
 
         # Resize to input resolution
         image = image.resize(self.image_size)
@@ -73,6 +96,10 @@ class NuScenesMapDataset(Dataset):
     
 
     def load_calib(self, token):
+        return self.calibs[token].clone()
+    
+
+    def get_calib(self, token):
 
         # Load camera intrinsics matrix
         sample_data = self.nuscenes.get('sample_data', token)
@@ -86,18 +113,51 @@ class NuScenesMapDataset(Dataset):
         return intrinsics
     
 
+    def open_label_db(self):
+
+        # LMDB environments cannot be shared across a fork, so each 
+        # dataloader worker opens its own read-only handle on first use
+        import lmdb
+        return lmdb.open(self.label_db, readonly=True, lock=False, 
+                         readahead=False, meminit=False)
+
+
     def load_labels(self, token):
 
-        # Load label image as a torch tensor
-        label_path = os.path.join(self.map_root, token + '.png')
-        encoded_labels = to_tensor(Image.open(label_path)).long()
+        # Load encoded label image as a numpy array
+        if self.label_db is None:
+            if token not in self.label_paths:
+                raise FileNotFoundError(
+                    f"No labels for token '{token}' in {self.map_root}")
+            label_file = self.label_paths[token]
+        else:
+            if self.label_env is None:
+                self.label_env = self.open_label_db()
+            with self.label_env.begin() as txn:
+                buffer = txn.get(token.encode())
+            if buffer is None:
+                raise KeyError(
+                    f"No labels for token '{token}' in {self.label_db}")
+            label_file = io.BytesIO(buffer)
+        encoded_labels = np.asarray(Image.open(label_file))
 
         # Decode to binary labels
         num_class = len(NUSCENES_CLASS_NAMES)
-        labels = decode_binary_labels(encoded_labels, num_class + 1)
+        labels = unpack_binary_labels(encoded_labels, num_class + 1)
+        labels = torch.from_numpy(labels)
         labels, mask = labels[:-1], ~labels[-1]
 
         return labels, mask
-    
 
 
+def index_label_files(map_root):
+
+    # Index label files with a single directory scan
+    label_paths = dict()
+    with os.scandir(os.path.expandvars(map_root)) as entries:
+        for entry in entries:
+            token, ext = os.path.splitext(entry.name)
+            if ext == '.png':
+                label_paths[token] = entry.path
+    
+    return label_paths
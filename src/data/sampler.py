@@ -0,0 +1,40 @@
+import torch
+from torch.utils.data import Sampler
+
+
+class ReplacementSampler(Sampler):
+    """
+    Draws a fixed number of examples with replacement each epoch, generating 
+    all indices with a single call to torch.randint. When training on 
+    multiple processes, each process iterates over its own shard of the 
+    indices.
+    """
+
+    def __init__(self, data_source, num_samples, rank=0, world_size=1, 
+                 seed=0):
+        self.data_source = data_source
+        self.num_samples = num_samples
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+    
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+    
+
+    def __len__(self):
+        return self.num_samples // self.world_size
+    
+
+    def __iter__(self):
+
+        # Seed identically on every process so that the shards are disjoint
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randint(len(self.data_source), 
+                                (len(self) * self.world_size,), 
+                                generator=generator)
+        
+        return iter(indices[self.rank::self.world_size].tolist())
@@ -8,6 +8,15 @@ def decode_binary_labels(labels, nclass):
     return (labels & bits.view(-1, 1, 1)) > 0
 
 
+def unpack_binary_labels(labels, nclass):
+    # Unpack the bits of each (little-endian) 32-bit label in one vectorised
+    # pass, rather than masking each class bit separately
+    labels = labels.astype('<i4', copy=False)
+    bits = np.unpackbits(labels.view(np.uint8).reshape(*labels.shape, 4),
+                         axis=-1, count=nclass, bitorder='little')
+    return np.ascontiguousarray(bits.transpose(2, 0, 1)).view(np.bool_)
+
+
 def encode_binary_labels(masks):
     bits = np.power(2, np.arange(len(masks), dtype=np.int32))
     return (masks.astype(np.int32) * bits.reshape(-1, 1, 1)).sum(0)
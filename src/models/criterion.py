@@ -39,27 +39,31 @@ class OccupancyCriterion(nn.Module):
         self.xent_weight = xent_weight
         self.uncert_weight = uncert_weight
 
-        self.priors = torch.tensor(priors)
+        priors = torch.tensor(priors)
 
         if weight_mode == 'inverse':
-            self.class_weights = 1 / self.priors
+            class_weights = 1 / priors
         elif weight_mode == 'sqrt_inverse':
-            self.class_weights = torch.sqrt(1 / self.priors)
+            class_weights = torch.sqrt(1 / priors)
         elif weight_mode == 'equal':
-            self.class_weights = torch.ones_like(self.priors)
+            class_weights = torch.ones_like(priors)
         else:
             raise ValueError('Unknown weight mode option: ' + weight_mode)
+        
+        # Register as buffers so that the criterion is placed on the same 
+        # device as the model outputs once, when it is built
+        self.register_buffer('priors', priors, persistent=False)
+        self.register_buffer('class_weights', class_weights, persistent=False)
     
 
+    @torch.amp.custom_fwd(device_type='cuda', cast_inputs=torch.float32)
     def forward(self, logits, labels, mask, *args):
 
         # Compute binary cross entropy loss
-        self.class_weights = self.class_weights.to(logits)
         bce_loss = balanced_binary_cross_entropy(
             logits, labels, mask, self.class_weights)
         
         # Compute uncertainty loss for unknown image regions
-        self.priors = self.priors.to(logits)
         uncert_loss = prior_uncertainty_loss(logits, mask, self.priors)
 
         return bce_loss * self.xent_weight + uncert_loss * self.uncert_weight
@@ -73,6 +77,7 @@ class FocalLossCriterion(nn.Module):
         self.alpha = alpha
         self.gamma = gamma
     
+    @torch.amp.custom_fwd(device_type='cuda', cast_inputs=torch.float32)
     def forward(self, logits, labels, mask, *args):
         return focal_loss(logits, labels, mask, self.alpha, self.gamma)
 
@@ -83,6 +88,7 @@ class PriorOffsetCriterion(nn.Module):
         super().__init__()
         self.priors = priors
     
+    @torch.amp.custom_fwd(device_type='cuda', cast_inputs=torch.float32)
     def forward(self, logits, labels, mask, *args):
         return prior_offset_loss(logits, labels, mask, self.priors)
 
@@ -96,6 +102,7 @@ class VaeOccupancyCriterion(OccupancyCriterion):
 
         self.kld_weight = kld_weight
     
+    @torch.amp.custom_fwd(device_type='cuda', cast_inputs=torch.float32)
     def forward(self, logits, labels, mask, mu, logvar):
 
         kld_loss = kl_divergence_loss(mu, logvar)
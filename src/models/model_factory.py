@@ -1,7 +1,9 @@
 import math
 from operator import mul
 from functools import reduce
+import torch
 import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
 from typing import Literal
 
 from .pyramid import PyramidOccupancyNetwork, HorizontallyAwarePyramidOccupancyNetwork
@@ -15,30 +17,77 @@ from ..nn.topdown import TopdownNetwork
 from ..nn.v_transformer_pyramid import VerticalTransformerPyramid
 from ..nn.h_transformer_pyramid import HorizontalTransformerPyramid
 from ..nn.classifier import LinearClassifier, BayesianClassifier
+from ..utils.distributed import init_distributed, get_local_rank
 
 
 
 def build_model(model_name, config):
 
-    if model_name == 'pon':
-        model = build_pyramid_occupancy_network(config)
-    elif model_name == 'hpon':
-        model = build_horizontally_aware_pyramid_occupancy_network(config, htfm_method='stack')
-    elif model_name == 'ved':
-        model = build_variational_encoder_decoder(config)
-    elif model_name == 'vpn':
-        model = build_view_parsing_network(config)
-    else:
-        raise ValueError("Unknown model name '{}'".format(model_name))
+    if len(config.gpus) > 1:
+        init_distributed(config)
+    
+    # Construct parameters directly on the target device, rather than 
+    # initialising them on the CPU and copying them across
+    device = get_device(config)
+    with device:
+        if model_name == 'pon':
+            model = build_pyramid_occupancy_network(config)
+        elif model_name == 'hpon':
+            model = build_horizontally_aware_pyramid_occupancy_network(
+                config, htfm_method='stack')
+        elif model_name == 'ved':
+            model = build_variational_encoder_decoder(config)
+        elif model_name == 'vpn':
+            model = build_view_parsing_network(config)
+        else:
+            raise ValueError("Unknown model name '{}'".format(model_name))
+    
+    # Synchronise batch norm statistics between processes, since the per-GPU
+    # batch size is small
+    if len(config.gpus) > 1:
+        model = nn.SyncBatchNorm.convert_sync_batchnorm(model)
+    
+    # Store convolution weights as NHWC to use tensor core kernels directly
+    if use_channels_last(model_name, config):
+        model = model.to(memory_format=torch.channels_last)
+    
+    # Compile the model into fused kernels. The pyramid transformers crop 
+    # each feature map using offsets computed from the calibration of each 
+    # sample, so only the frontend and topdown networks (whose input sizes 
+    # are fixed by the config) are compiled. Modules are compiled in place 
+    # so that parameter names are unchanged
+    if config.compile:
+        if model_name in ['pon', 'hpon']:
+            model.frontend.compile(dynamic=False)
+            model.topdown.compile(dynamic=False)
+        else:
+            model.compile(dynamic=False)
     
+    # One process per GPU, gradients are all-reduced during backward
     if len(config.gpus) > 1:
-        model = nn.DataParallel(model.cuda(), config.gpus)
-    elif len(config.gpus) == 1:
-        model.cuda()
+        model = DistributedDataParallel(model, 
+                                        device_ids=[device.index], 
+                                        output_device=device.index,
+                                        broadcast_buffers=False,
+                                        gradient_as_bucket_view=True)
     
     return model
 
 
+def get_device(config):
+    if len(config.gpus) == 0:
+        return torch.device('cpu')
+    
+    # Each process uses the GPU corresponding to its local rank
+    return torch.device('cuda', config.gpus[get_local_rank()])
+
+
+def use_channels_last(model_name, config):
+    # Only the pyramid networks are safe to run on NHWC inputs, the VED and 
+    # VPN baselines reshape convolution outputs with view
+    return config.channels_last and model_name in ['pon', 'hpon']
+
+
 def build_criterion(model_name, config):
 
     if model_name == 'ved':
@@ -57,10 +106,7 @@ def build_criterion(model_name, config):
         criterion = OccupancyCriterion(config.prior, config.xent_weight, 
                                        config.uncert_weight, config.weight_mode)
     
-    if len(config.gpus) > 0:
-        criterion.cuda()
-    
-    return criterion
+    return criterion.to(get_device(config))
 
 
 
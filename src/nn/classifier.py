@@ -39,7 +39,9 @@ class BayesianClassifier(nn.Module):
             mean_score = 0
             for _ in range(self.num_samples):
                 drop_feats = F.dropout2d(features, 0.5, training=True)
-                mean_score += F.sigmoid(self.conv(drop_feats))
+                # Accumulate in float32, since under autocast the sum of 
+                # reduced precision scores loses resolution as it grows
+                mean_score += F.sigmoid(self.conv(drop_feats).float())
             mean_score = mean_score / self.num_samples
 
             # Convert back into logits format
@@ -2,13 +2,19 @@
 Adapted from the implementation of
 https://github.com/kuangliu/pytorch-retinanet/
 '''
+import os
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from torchvision.models.utils import load_state_dict_from_url
+from torch.hub import load_state_dict_from_url
 
 from .resnet import ResNetLayer
+from ..utils.distributed import get_local_rank, barrier
+
+# Pretrained weights are staged in shared memory so that they can be 
+# memory-mapped by every process instead of being unpickled from the hub cache
+WEIGHTS_CACHE = '/dev/shm'
 
 
 class FPN(nn.Module):
@@ -42,8 +48,14 @@ class FPN(nn.Module):
         self.register_buffer('std', torch.tensor([0.229, 0.224, 0.225]))
 
     
-    def load_pretrained(self, path):
-        pretrained = load_state_dict_from_url(path, progress=True)
+    def load_pretrained(self, url):
+        path = stage_pretrained(url)
+        if path is not None and os.path.isfile(path):
+            pretrained = torch.load(path, map_location='cpu', mmap=True, 
+                                    weights_only=True)
+        else:
+            pretrained = load_state_dict_from_url(url, progress=True)
+        
         state_dict = self.state_dict()
         for key, weights in pretrained.items():
             if key in state_dict:
@@ -99,6 +111,35 @@ class FPN(nn.Module):
         return p3, p4, p5, p6, p7
 
 
+def stage_pretrained(url):
+
+    if not os.path.isdir(WEIGHTS_CACHE):
+        return url
+    
+    # Only the first process on each machine writes the cached copy, 
+    # re-saving it in the zipfile format required for memory mapping
+    path = os.path.join(WEIGHTS_CACHE, os.path.basename(url))
+    if get_local_rank() == 0 and not os.path.exists(path):
+
+        # Write to a file unique to this process, so that concurrent jobs 
+        # never see a partially written copy
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            torch.save(load_state_dict_from_url(url, progress=True), tmp_path)
+            os.replace(tmp_path, path)
+        
+        # Shared memory may be too small to hold the weights (e.g. the 64MB 
+        # default in docker), in which case every process loads from the URL
+        except OSError as err:
+            print(f'Unable to stage pretrained weights in {WEIGHTS_CACHE}: '
+                  f'{err}')
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    barrier()
+
+    return path
+
+
 def FPN50():
     fpn = FPN([3,4,6,3])
     fpn.load_pretrained(
@@ -13,28 +13,37 @@ class Resampler(nn.Module):
         self.near = extents[1]
         self.far = extents[3]
 
-        # Make a grid in the x-z plane
-        self.grid = _make_grid(resolution, extents)
+        # Make a grid in the x-z plane. The grid is fixed for a given map 
+        # resolution and extents, so it is stored as a (non-persistent) buffer
+        # which moves with the module, rather than being copied to the 
+        # feature device on every forward pass
+        self.register_buffer(
+            'grid', _make_grid(resolution, extents), persistent=False)
 
 
     def forward(self, features, calib):
 
-        # Copy grid to the correct device
-        self.grid = self.grid.to(features)
-        
-        # We ignore the image v-coordinate, and assume the world Y-coordinate
-        # is zero, so we only need a 2x2 submatrix of the original 3x3 matrix
-        calib = calib[:, [0, 2]][..., [0, 2]].view(-1, 1, 1, 2, 2)
+        # Compute sampling coordinates in float32 even under autocast, since
+        # image u-coordinates reach the thousands where reduced precision 
+        # types cannot resolve sub-pixel offsets
+        with torch.autocast('cuda', enabled=False):
 
-        # Transform grid center locations into image u-coordinates
-        cam_coords = torch.matmul(calib, self.grid.unsqueeze(-1)).squeeze(-1)
+            # We ignore the image v-coordinate, and assume the world 
+            # Y-coordinate is zero, so we only need a 2x2 submatrix of the 
+            # original 3x3 matrix
+            calib = calib.float()[:, [0, 2]][..., [0, 2]].view(-1, 1, 1, 2, 2)
 
-        # Apply perspective projection and normalize
-        ucoords = cam_coords[..., 0] / cam_coords[..., 1]
-        ucoords = ucoords / features.size(-1) * 2 - 1
+            # Transform grid center locations into image u-coordinates
+            cam_coords = torch.matmul(
+                calib, self.grid.float().unsqueeze(-1)).squeeze(-1)
 
-        # Normalize z coordinates
-        zcoords = (cam_coords[..., 1]-self.near) / (self.far-self.near) * 2 - 1
+            # Apply perspective projection and normalize
+            ucoords = cam_coords[..., 0] / cam_coords[..., 1]
+            ucoords = ucoords / features.size(-1) * 2 - 1
+
+            # Normalize z coordinates
+            zcoords = (cam_coords[..., 1] - self.near) \
+                / (self.far - self.near) * 2 - 1
 
         # Resample 3D feature map
         grid_coords = torch.stack([ucoords, zcoords], -1).clamp(-1.1, 1.1)
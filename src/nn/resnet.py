@@ -96,7 +96,7 @@ class Bottleneck(nn.Module):
             identity = self.downsample(x)
 
         out += identity
-        out = F.relu(out)
+        out = F.relu(out, inplace=True)
 
         return out
 
@@ -0,0 +1,60 @@
+import os
+import torch
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank():
+    # Set by torchrun for each process it launches
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(config):
+    """
+    Start one NCCL process group per GPU when training on multiple devices.
+    Expects to be launched with torchrun, which provides the rank environment.
+    """
+    if len(config.gpus) > 1 and not is_distributed():
+        dist.init_process_group(backend='nccl')
+
+    # Each process drives the GPU corresponding to its local rank
+    if len(config.gpus) > 0:
+        torch.cuda.set_device(config.gpus[get_local_rank()])
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src)
+    return objects[0]
+
+
+def all_reduce_sum(tensor):
+    if not is_distributed():
+        return tensor
+    
+    # NCCL only operates on GPU tensors
+    reduced = tensor.cuda()
+    dist.all_reduce(reduced)
+    return reduced.to(tensor.device)
@@ -1,26 +1,45 @@
 
 import os
+from contextlib import nullcontext
 from datetime import datetime
 from argparse import ArgumentParser
 from tqdm import tqdm
 
 import torch
 import torch.nn as nn
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import SGD
 from torch.optim.lr_scheduler import MultiStepLR
 from torch.utils.tensorboard import SummaryWriter
 
-from src.models.model_factory import build_model, build_criterion
+from src.models.model_factory import build_model, build_criterion, \
+    use_channels_last
 from src.data.data_factory import build_dataloaders
+from src.data.augmentation import random_hflip
 from src.utils.configs import get_default_configuration, load_config
 from src.utils.confusion import BinaryConfusionMatrix
+from src.utils.distributed import init_distributed, is_main_process, \
+    broadcast_object, all_reduce_sum
 from src.data.nuscenes.utils import NUSCENES_CLASS_NAMES
 from src.data.argoverse.utils import ARGOVERSE_CLASS_NAMES
 from src.utils.visualise import colorise
 
-def train(dataloader, model, criterion, optimiser, summary, config, epoch):
+# Reduced precision types used for mixed precision training
+AMP_DTYPES = {'fp16' : torch.float16, 'bf16' : torch.bfloat16}
+
+
+def autocast(config):
+    return torch.autocast('cuda', dtype=AMP_DTYPES.get(config.precision),
+                          enabled=len(config.gpus) > 0 \
+                            and config.precision in AMP_DTYPES)
+
+
+def train(dataloader, model, criterion, optimiser, scaler, summary, config, 
+          epoch):
 
     model.train()
+    optimiser.zero_grad()
 
     # Compute prior probability of occupancy
     prior = torch.tensor(config.prior)
@@ -31,29 +50,48 @@ def train(dataloader, model, criterion, optimiser, summary, config, epoch):
     
     # Iterate over dataloader
     iteration = (epoch - 1) * len(dataloader)
-    for i, batch in enumerate(tqdm(dataloader)):
+    for i, batch in enumerate(tqdm(dataloader, disable=not is_main_process())):
 
         # Move tensors to GPU
         if len(config.gpus) > 0:
-            batch = [t.cuda() for t in batch]
+            batch = [t.cuda(non_blocking=True) for t in batch]
         
-        # Predict class occupancy scores and compute loss
         image, calib, labels, mask = batch
-        if config.model == 'ved':
-            logits, mu, logvar = model(image)
-            loss = criterion(logits, labels, mask, mu, logvar)
-        else:
-            logits = model(image, calib)
-            loss = criterion(logits, labels, mask)
 
+        # Apply data augmentation
+        if config.hflip:
+            image, labels, mask = random_hflip(image, labels, mask)
 
-        # Compute gradients and update parameters
-        optimiser.zero_grad()
-        loss.backward()
-        optimiser.step()
+        if use_channels_last(config.model, config):
+            image = image.to(memory_format=torch.channels_last)
+        
+        # Predict class occupancy scores and compute loss
+        with autocast(config):
+            if config.model == 'ved':
+                logits, mu, logvar = model(image)
+                loss = criterion(logits, labels, mask, mu, logvar)
+            else:
+                logits = model(image, calib)
+                loss = criterion(logits, labels, mask)
+
+
+        # Compute gradients, accumulating over several batches if requested.
+        # Gradients are only synchronised between processes on the last one,
+        # and any remaining batches at the end of the epoch are also applied
+        update = (i + 1) % config.accumulation_steps == 0 \
+            or i + 1 == len(dataloader)
+        with nullcontext() if update or not hasattr(model, 'no_sync') \
+                else model.no_sync():
+            scaler.scale(loss / config.accumulation_steps).backward()
+
+        # Update parameters
+        if update:
+            scaler.step(optimiser)
+            scaler.update()
+            optimiser.zero_grad()
 
         # Update confusion matrix
-        scores = logits.cpu().sigmoid()  
+        scores = logits.float().cpu().sigmoid()  
         confusion.update(scores > config.score_thresh, labels.cpu(), mask.cpu())
 
         # Update tensorboard
@@ -85,15 +123,17 @@ def evaluate(dataloader, model, criterion, summary, config, epoch):
     confusion = BinaryConfusionMatrix(config.num_class)
     
     # Iterate over dataset
-    for i, batch in enumerate(tqdm(dataloader)):
+    for i, batch in enumerate(tqdm(dataloader, disable=not is_main_process())):
 
         # Move tensors to GPU
         if len(config.gpus) > 0:
-            batch = [t.cuda() for t in batch]
+            batch = [t.cuda(non_blocking=True) for t in batch]
         
         # Predict class occupancy scores and compute loss
         image, calib, labels, mask = batch
-        with torch.no_grad():
+        if use_channels_last(config.model, config):
+            image = image.to(memory_format=torch.channels_last)
+        with torch.no_grad(), autocast(config):
             if config.model == 'ved':
                 logits, mu, logvar = model(image)
                 loss = criterion(logits, labels, mask, mu, logvar)
@@ -102,7 +142,7 @@ def evaluate(dataloader, model, criterion, summary, config, epoch):
                 loss = criterion(logits, labels, mask)
 
         # Update confusion matrix
-        scores = logits.cpu().sigmoid()  
+        scores = logits.float().cpu().sigmoid()  
         confusion.update(scores > config.score_thresh, labels.cpu(), mask.cpu())
 
         # Update tensorboard
@@ -114,6 +154,10 @@ def evaluate(dataloader, model, criterion, summary, config, epoch):
             visualise(summary, image, scores, labels, mask, epoch, 
                       config.train_dataset, split='val')
 
+    # Accumulate results over all processes
+    for counts in [confusion.tp, confusion.fp, confusion.fn, confusion.tn]:
+        counts.copy_(all_reduce_sum(counts))
+
     # Print and record results
     display_results(confusion, config.train_dataset)
     log_results(confusion, config.train_dataset, summary, 'val', epoch)
@@ -123,6 +167,9 @@ def evaluate(dataloader, model, criterion, summary, config, epoch):
 
 def visualise(summary, image, scores, labels, mask, step, dataset, split):
 
+    if not is_main_process():
+        return
+
     class_names = NUSCENES_CLASS_NAMES if dataset == 'nuscenes' \
         else ARGOVERSE_CLASS_NAMES
 
@@ -144,6 +191,9 @@ def visualise(summary, image, scores, labels, mask, step, dataset, split):
 
 def display_results(confusion, dataset):
 
+    if not is_main_process():
+        return
+
     # Display confusion matrix summary
     class_names = NUSCENES_CLASS_NAMES if dataset == 'nuscenes' \
         else ARGOVERSE_CLASS_NAMES
@@ -167,10 +217,26 @@ def log_results(confusion, dataset, summary, split, epoch):
 
 
 
-def save_checkpoint(path, model, optimizer, scheduler, epoch, best_iou):
+class NullSummary(object):
+    """
+    Stands in for a SummaryWriter on processes other than the main one, 
+    discarding everything logged to it
+    """
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def unwrap_model(model):
 
-    if isinstance(model, nn.DataParallel):
+    # Recover the original module from data parallel and compiled wrappers
+    if isinstance(model, (nn.DataParallel, DistributedDataParallel)):
         model = model.module
+    return getattr(model, '_orig_mod', model)
+
+
+def save_checkpoint(path, model, optimizer, scheduler, epoch, best_iou):
+
+    model = unwrap_model(model)
     
     ckpt = {
         'model' : model.state_dict(),
@@ -185,12 +251,10 @@ def save_checkpoint(path, model, optimizer, scheduler, epoch, best_iou):
 
 def load_checkpoint(path, model, optimizer, scheduler):
     
-    ckpt = torch.load(path)
+    ckpt = torch.load(path, map_location='cpu')
 
     # Load model weights
-    if isinstance(model, nn.DataParallel):
-        model = model.module
-    model.load_state_dict(ckpt['model'])
+    unwrap_model(model).load_state_dict(ckpt['model'])
 
     # Load optimiser state
     optimizer.load_state_dict(ckpt['optimizer'])
@@ -276,18 +340,24 @@ def main():
                         help='list of addition config options as key-val pairs')
     args = parser.parse_args()
 
+    # Fork dataloader workers so they share the dataset metadata loaded by 
+    # the main process instead of each reloading it
+    mp.set_start_method('fork', force=True)
+
     # Load configuration
     config = get_configuration(args)
-    
-    # Create a directory for the experiment
-    logdir = create_experiment(config, args.tag, args.resume)
 
-    # Create tensorboard summary 
-    summary = SummaryWriter(logdir)
+    # Start one process per GPU and set the default device
+    init_distributed(config)
+    
+    # Create a directory for the experiment on the main process only
+    logdir = None
+    if is_main_process():
+        logdir = create_experiment(config, args.tag, args.resume)
+    logdir = broadcast_object(logdir)
 
-    # Set default device
-    if len(config.gpus) > 0:
-        torch.cuda.set_device(config.gpus[0])
+    # Create tensorboard summary, only written by the main process
+    summary = SummaryWriter(logdir) if is_main_process() else NullSummary()
 
     # Setup experiment
     model = build_model(config.model, config)
@@ -299,6 +369,11 @@ def main():
                     weight_decay=config.weight_decay)
     lr_scheduler = MultiStepLR(optimiser, config.lr_milestones, 0.1)
 
+    # Scale losses to avoid underflow in float16 gradients (bfloat16 has the 
+    # same range as float32 so does not need scaling)
+    scaler = torch.amp.GradScaler('cuda', enabled=len(config.gpus) > 0 \
+                                  and config.precision == 'fp16')
+
     # Load checkpoint
     if args.resume:
         epoch, best_iou = load_checkpoint(os.path.join(logdir, 'latest.pth'),
@@ -309,11 +384,17 @@ def main():
     # Main training loop
     while epoch <= config.num_epochs:
         
-        print('\n\n=== Beginning epoch {} of {} ==='.format(epoch, 
-                                                            config.num_epochs))
+        if is_main_process():
+            print('\n\n=== Beginning epoch {} of {} ==='.format(
+                epoch, config.num_epochs))
         
+        # Reshuffle the distributed training shards
+        if hasattr(getattr(train_loader, 'sampler', None), 'set_epoch'):
+            train_loader.sampler.set_epoch(epoch)
+
         # Train model for one epoch
-        train(train_loader, model, criterion, optimiser, summary, config, epoch)
+        train(train_loader, model, criterion, optimiser, scaler, summary, 
+              config, epoch)
 
         # Evaluate on the validation set
         val_iou = evaluate(val_loader, model, criterion, summary, config, epoch)
@@ -324,11 +405,13 @@ def main():
         # Save checkpoints
         if val_iou > best_iou:
             best_iou = val_iou
-            save_checkpoint(os.path.join(logdir, 'best.pth'), model, 
-                            optimiser, lr_scheduler, epoch, best_iou)
+            if is_main_process():
+                save_checkpoint(os.path.join(logdir, 'best.pth'), model, 
+                                optimiser, lr_scheduler, epoch, best_iou)
         
-        save_checkpoint(os.path.join(logdir, 'latest.pth'), model, optimiser, 
-                        lr_scheduler, epoch, best_iou)
+        if is_main_process():
+            save_checkpoint(os.path.join(logdir, 'latest.pth'), model, 
+                            optimiser, lr_scheduler, epoch, best_iou)
         
         epoch += 1
     